@@ -11,16 +11,146 @@ if sys.version_info[0] == 3 and '/opt/ros/kinetic/lib/python2.7/dist-packages' i
     sys.path.remove('/opt/ros/kinetic/lib/python2.7/dist-packages') # so can import opencv for python3, silly ROS
 import cv2 as cv
 
-# Reads in a dataset file
+# Reads in a dataset file, the returned dataset is always read only
+# The parsed dataset is also saved as a binary file next to the text file (dataset.npy for dataset.txt), which is
+# memory mapped instead of parsing the text file again. The size and modification time of the text file it was parsed
+# from are saved alongside it (dataset.npy.source), and the binary file is only used when both match the text file
+# exactly, as copying with rsync -a, cp -p or tar can give a different dataset an older modification time
 def ReadDatasetFile(dataset_file_path):
-    dataset = np.genfromtxt(dataset_file_path, delimiter=', ', skip_header=1)
-    if len(dataset.shape) == 1: # will occur if there is a single teach in the dataset
-        dataset = np.reshape(dataset, (1,dataset.shape[0]))
-    dataset[:,0] = np.arange(0, dataset.shape[0]) # add in frame IDs to column 1, else will be NAN
+    binary_file_path = os.path.splitext(dataset_file_path)[0] + '.npy'
+    source_file_path = binary_file_path + '.source'
+    dataset_stat = os.stat(dataset_file_path)
+    source_stamp = '%d %r\n'%(dataset_stat.st_size, dataset_stat.st_mtime)
+    try:
+        with open(source_file_path, 'r') as source_file:
+            if source_file.read() == source_stamp:
+                return np.load(binary_file_path, mmap_mode='r')
+    except (IOError, OSError, ValueError, EOFError):
+        pass # missing or unreadable binary file, parse the text file instead and replace it
+
+    # Column 0 holds frame names rather than numbers, so only parse the odom and pose columns
+    values = np.loadtxt(dataset_file_path, delimiter=',', skiprows=1, usecols=range(1, 7), ndmin=2)
+    dataset = np.empty((values.shape[0], values.shape[1]+1))
+    dataset[:,0] = np.arange(0, dataset.shape[0]) # add in frame IDs to column 1
+    dataset[:,1:] = values
+    dataset.flags.writeable = False # same as the memory mapped binary file
+
+    # Write to temporary files then rename them into place, so other nodes reading the dataset at the same time
+    # never see a partially written file. The binary file is renamed first, so it can only be paired with an
+    # out of date source file (and so be parsed again), never the other way round.
+    temp_file_path = '%s.%d.tmp'%(binary_file_path, os.getpid())
+    temp_source_file_path = '%s.%d.tmp'%(source_file_path, os.getpid())
+    try:
+        with open(temp_file_path, 'wb') as temp_file:
+            np.save(temp_file, dataset)
+        with open(temp_source_file_path, 'w') as temp_source_file:
+            temp_source_file.write(source_stamp)
+        os.rename(temp_file_path, binary_file_path)
+        os.rename(temp_source_file_path, source_file_path)
+    except (IOError, OSError):
+        # e.g. read only dataset directory, the text file will just be parsed again next time
+        for path in (temp_file_path, temp_source_file_path):
+            if os.path.exists(path):
+                os.remove(path)
 
     return dataset
 
 
+# Reads in the processed teach images of a dataset into a single contiguous grayscale image stack (num_frames x height x width)
+# image_size is (width, height) as used by cv.resize, images not already at this size are resized
+def ReadTeachImages(dataset_path, num_frames, image_size):
+    teach_imgs = np.empty((num_frames, image_size[1], image_size[0]), dtype=np.uint8)
+    for frame_id in range(num_frames):
+        img = cv.imread(os.path.join(dataset_path, 'frame_%06d.png'%(frame_id)), cv.IMREAD_GRAYSCALE)
+        if img is None:
+            raise IOError('Unable to read teach image frame_%06d.png in %s'%(frame_id, dataset_path))
+        if img.shape != teach_imgs.shape[1:]:
+            img = cv.resize(img, tuple(image_size), interpolation=cv.INTER_AREA)
+        teach_imgs[frame_id] = img
+
+    return teach_imgs
+
+
+# Reads in the raw (still encoded) image files of a dataset, decode an image with cv.imdecode when it is needed
+# Keeps a dataset in memory at its size on disk, rather than the much larger size of the decoded images
+def ReadEncodedTeachImages(dataset_path, num_frames):
+    return [np.fromfile(os.path.join(dataset_path, 'frame_%06d.png'%(frame_id)), dtype=np.uint8) for frame_id in range(num_frames)]
+
+
+# Preprocess a BGR image for matching (resize to image_size, given as (width, height), and convert to grayscale)
+# Resizing with area averaging first means the grayscale conversion only touches the small image
+def PreprocessImage(img_bgr, image_size):
+    img_small = cv.resize(img_bgr, tuple(image_size), interpolation=cv.INTER_AREA)
+    return cv.cvtColor(img_small, cv.COLOR_BGR2GRAY)
+
+
+# Version of the PreprocessImage steps, written into processed teach datasets by preprocess_teach_images so that the
+# repeat nodes can detect teach images that were preprocessed differently to their repeat images
+# Version 1 (no version file) converted to grayscale first, then resized with the default linear interpolation
+PREPROCESSING_VERSION = 2
+PREPROCESSING_VERSION_FILE = 'preprocessing_version'
+
+# Writes the current preprocessing version into a processed dataset directory
+def WritePreprocessingVersion(dataset_path):
+    with open(os.path.join(dataset_path, PREPROCESSING_VERSION_FILE), 'w') as version_file:
+        version_file.write('%d\n'%(PREPROCESSING_VERSION))
+
+# Reads the preprocessing version of a processed dataset directory, returns None if it has no (readable) version file
+def ReadPreprocessingVersion(dataset_path):
+    try:
+        with open(os.path.join(dataset_path, PREPROCESSING_VERSION_FILE), 'r') as version_file:
+            return int(version_file.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+# Resizes every image in a stack of images (num_imgs x height x width), image_size is (width, height) as used by cv.resize
+def ResizeImageStack(imgs, image_size):
+    imgs_resized = np.empty((imgs.shape[0], image_size[1], image_size[0]), dtype=imgs.dtype)
+    for i in range(imgs.shape[0]):
+        imgs_resized[i] = cv.resize(imgs[i], tuple(image_size), interpolation=cv.INTER_AREA)
+
+    return imgs_resized
+
+
+# Template matching methods that can be used by MatchPatch, by parameter name
+MATCH_METHODS = {'ccoeff_normed': cv.TM_CCOEFF_NORMED, 'sqdiff': cv.TM_SQDIFF, 'sqdiff_normed': cv.TM_SQDIFF_NORMED}
+
+# Template match a patch against a stack of images (equivalent to cv.matchTemplate on each image)
+# returns a (num_imgs x img_height-patch_height+1 x img_width-patch_width+1) array of scores, where higher is always a better match
+# (squared difference methods are negated)
+def MatchPatch(imgs, patch, method=cv.TM_CCOEFF_NORMED):
+    num_imgs, img_height, img_width = imgs.shape
+    patch_height, patch_width = patch.shape
+
+    # Place the images side by side in a single (height x num_imgs*width) strip and match once
+    strip = np.ascontiguousarray(imgs.transpose(1, 0, 2)).reshape(img_height, num_imgs*img_width)
+    strip_result = cv.matchTemplate(strip, patch, method)
+    if method in (cv.TM_SQDIFF, cv.TM_SQDIFF_NORMED):
+        strip_result = -strip_result
+
+    # Column x of the strip result lies in image x // img_width at offset x % img_width. Offsets past
+    # img_width-patch_width straddle two images, so are dropped.
+    result = np.empty((img_height-patch_height+1, num_imgs*img_width), dtype=strip_result.dtype)
+    result[:, :strip_result.shape[1]] = strip_result
+    result = result.reshape(img_height-patch_height+1, num_imgs, img_width)[:, :, :img_width-patch_width+1]
+
+    return result.transpose(1, 0, 2)
+
+
+# Cumulative transforms along a teach dataset (num_frames x 4 x 4), where cum_tf[i] is the transform from
+# frame 0 to frame i. Frame i's relative odom (columns 1 to 3) is the transform from frame i-1 to frame i.
+def TeachCumulativeTransforms(teach_dataset):
+    step_tf = transform_tools.trans_from_xy_yaw(teach_dataset[:, 1], teach_dataset[:, 2], teach_dataset[:, 3])
+
+    cum_tf = np.empty_like(step_tf)
+    cum_tf[0] = np.identity(4)
+    for i in range(1, teach_dataset.shape[0]):
+        cum_tf[i] = transform_tools.append_trans(cum_tf[i-1], step_tf[i])
+
+    return cum_tf
+
+
 # Calculate Transform Between Two Pose Messages
 def CalculateTransformBetweenPoseMessages(pose_at_current_frame, pose_at_previous_frame):
     # Check if either argument is none
@@ -59,14 +189,8 @@ def WriteDataToDatasetFile(img, frame_id, save_path, relative_odom_trans, relati
 
     return 0
 
-# Crop an image from its center based on a portion
-def ImageCropCenter(img, portion):
-    if len(img.shape) == 2:
-        img_height, img_width = img.shape
-        channels = 1
-    else:
-        img_height, img_width, channels = img.shape
-
+# Get the (row, column) slices that crop an image of the given size from its center based on a portion
+def CropCenterSlices(img_height, img_width, portion):
     # portion is from from 0 to 1 
     patch_width = int(min(max(round(img_width * portion), 1), img_width))
     patch_height = int(min(max(round(img_height * portion), 1), img_height))
@@ -74,10 +198,11 @@ def ImageCropCenter(img, portion):
     startx = int(img_width//2-(patch_width//2))
     starty = int(img_height//2-(patch_height//2))
 
-    if channels == 1:
-        return img[starty:starty+patch_height,startx:startx+patch_width]
-    else:
-        return img[starty:starty+patch_height,startx:startx+patch_width, :]
+    return slice(starty, starty+patch_height), slice(startx, startx+patch_width)
+
+# Crop an image from its center based on a portion
+def ImageCropCenter(img, portion):
+    return img[CropCenterSlices(img.shape[0], img.shape[1], portion)]
         
 # Draws a rectangle on image
 def DrawCropPatchOnImage(img, portion, center=np.array([])):
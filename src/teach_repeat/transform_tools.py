@@ -78,6 +78,22 @@ def trans_from_yaw(yaw, affine=None):
         return ret
 
 
+def trans_from_xy_yaw(x, y, yaw):
+    """Returns the planar trans for position x, y and yaw (arrays give a stack of trans)"""
+    x, y, yaw = np.broadcast_arrays(x, y, yaw)
+    c, s = np.cos(yaw), np.sin(yaw)
+    trans = np.zeros(yaw.shape + (4, 4))
+    trans[..., 0, 0] = c
+    trans[..., 0, 1] = -s
+    trans[..., 1, 0] = s
+    trans[..., 1, 1] = c
+    trans[..., 0, 3] = x
+    trans[..., 1, 3] = y
+    trans[..., 2, 2] = 1
+    trans[..., 3, 3] = 1
+    return trans
+
+
 def trans_from_xyzrpy(x, y, z, roll, pitch, yaw):
     return t3.affines.compose([x, y, z], t3.euler.euler2mat(roll, pitch, yaw),
                               [1, 1, 1])